@@ -4,166 +4,418 @@ import sys
 import shlex
 import typing as t
 import hashlib
+import functools
+import itertools
+import json
 import subprocess
 import time
 import os
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, field
 from pathlib import Path
 
 MAX_ARGUMENT_LENGTH: int = 240
 HEX_DIGEST_SIZE_BYTES: int = 8
+RPATH_PREFIX: str = '-Wl,-rpath,'
+# Part of the hijack_cached() key; bump whenever the rewriting logic changes, so that
+# entries cached by older versions are not reused
+CACHE_VERSION: int = 1
+
+# BLAKE3 is faster on the short inputs we hash, but keep it an optional dependency.
+# NOTE: the two produce different digests, so aliases created by one are not reused by the other.
+try:
+    from blake3 import blake3
+
+    HASH_ALGORITHM: str = 'blake3'
+
+    def _hexdigest(data: bytes) -> str:
+        return blake3(data).hexdigest(length=HEX_DIGEST_SIZE_BYTES)
+except ImportError:
+    HASH_ALGORITHM: str = 'blake2b'
+
+    def _hexdigest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=HEX_DIGEST_SIZE_BYTES).hexdigest()
 
 
 @dataclass
 class Config:
-    cwd: Path
-    prefix: Path
+    # Path objects are accepted, but stored as plain strings which are much
+    # cheaper to work with
+    cwd: t.Union[str, os.PathLike]
+    prefix: t.Union[str, os.PathLike]
     rewrite_rsp: bool = False
+    # where the aliases are created; same as prefix if that is absolute
+    prefix_dir: str = field(init=False)
+
+    def __post_init__(self):
+        self.cwd = os.fspath(self.cwd)
+        self.prefix = os.path.normpath(self.prefix)
+        self.prefix_dir = os.path.join(self.cwd, self.prefix)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_dir(path: t.Union[str, os.PathLike]) -> str:
+    # Build commands typically pass many files from only a handful of directories,
+    # so memoize on the directory path instead of rehashing each time. Thanks to that,
+    # normalizing via Path (so that e.g. 'foo/bar' and 'foo/bar/' map to the same
+    # alias) happens only once per distinct path.
+    return _hexdigest(os.fsencode(Path(path)))
+
+
+# Options followed by a file path argument
+_FLAG_CO = frozenset(('-c', '-o'))
+# Positional arguments with these suffixes are libraries passed during linking
+_LIB_SUFFIXES = frozenset(('.a', '.so', '.dylib', '.lib'))
+# Known types of files under 'CMakeFiles'; add to these if needed
+_CMAKE_SUFFIXES = frozenset(('.d', '.o', '.dep'))
+
+# Kinds of arguments recognized by _parse()
+ARG_VERBATIM = 'verbatim'  # passed through as-is
+ARG_FILE = 'file'          # path to a file; its parent directory gets aliased
+ARG_DIR = 'dir'            # path to a directory which gets aliased
+ARG_RPATH = 'rpath'        # directory in a '-Wl,-rpath,<dir>' argument
+ARG_RSP = 'rsp'            # response file, '@<path>'
+
+
+def _trim(path: str) -> str:
+    # Drops trailing slashes and '.' components, which Path ignores, e.g. 'foo/./' -> 'foo'
+    trimmed = path
+    while len(trimmed) > 1 and trimmed.endswith(('/', '/.')):
+        trimmed = trimmed[:-1] if trimmed[-1] == '/' else trimmed[:-2]
+    if trimmed in ('', '/') and path.startswith('/'):
+        # only the root is left; like POSIX, Path keeps exactly two leading slashes
+        return '//' if path.startswith('//') and not path.startswith('///') else '/'
+    return trimmed
+
+
+def _suffix(arg: str) -> str:
+    # Equivalent to Path(arg).suffix, minus the cost of constructing a Path
+    arg = _trim(arg)
+    dot = arg.rfind('.')
+    if dot <= arg.rfind('/') + 1 or dot == len(arg) - 1:
+        return ''
+    return arg[dot:]
+
+
+def _split(path: str) -> t.Tuple[str, str]:
+    # Like (Path(path).parent, Path(path).name), as far as we care
+    path = _trim(path)
+    if path == '.':
+        return '.', ''
+    parent, name = os.path.split(path)
+    return parent or '.', name
+
+
+def _join(alias_dir: str, name: str) -> str:
+    # Like str(Path(alias_dir) / name), i.e. no trailing slash when name is empty
+    return f'{alias_dir}/{name}' if name else alias_dir
+
+
+class ParsedArg(t.NamedTuple):
+    value: str
+    kind: str = ARG_VERBATIM
+
+
+# Argument handlers used by _parse(). Each one is given the argument list and the index
+# of the current argument, emits the parsed argument(s), and returns the index of the
+# next argument to handle.
+_Emit = t.Callable[[ParsedArg], None]
+
+
+def _parse_positional(args: t.List[str], i: int, emit: _Emit) -> int:
+    curr_arg = args[i]
+    suffix = _suffix(curr_arg)
+    if suffix in _LIB_SUFFIXES:
+        # positional argument, usually libraries passed during linking step
+        # Paths to these usually do not have the 'CMakeFiles' component in them
+        emit(ParsedArg(curr_arg, ARG_FILE))
+    elif 'CMakeFiles' in curr_arg:
+        if suffix not in _CMAKE_SUFFIXES:
+            # There might be omissions, add known extensions to the above list if needed
+            raise RuntimeError(f'Uknown CMakeFiles file type: {curr_arg}?')
+        emit(ParsedArg(curr_arg, ARG_FILE))
+    else:
+        # Anything our heuristic did not recognize is passed as-is
+        emit(ParsedArg(curr_arg))
+    return i + 1
+
+
+def _parse_file_option(args: t.List[str], i: int, emit: _Emit) -> int:
+    # handles ['-c', 'foo/bar.c'] and ['-o', 'foo/bar.o']
+    if args[i] not in _FLAG_CO:
+        return _parse_positional(args, i, emit)
+    emit(ParsedArg(args[i]))
+    if i+1 >= len(args) or not args[i+1]:
+        return len(args)  # out of args
+    emit(ParsedArg(args[i+1], ARG_FILE))
+    return i + 2
+
+
+def _parse_dir_option(args: t.List[str], i: int, emit: _Emit) -> int:
+    # handles ['-I', 'foo/bar'] and ['-Ifoo/bar'] equally (same for -L)
+    curr_arg = args[i]
+    emit(ParsedArg(curr_arg[:2]))
+    if remainder := curr_arg[2:]:
+        emit(ParsedArg(remainder, ARG_DIR))
+        return i + 1
+    if i+1 >= len(args) or not args[i+1]:
+        return len(args)  # out of args
+    emit(ParsedArg(args[i+1], ARG_DIR))
+    return i + 2
+
+
+def _parse_linker_option(args: t.List[str], i: int, emit: _Emit) -> int:
+    curr_arg = args[i]
+    if not curr_arg.startswith(RPATH_PREFIX):
+        return _parse_positional(args, i, emit)
+    emit(ParsedArg(curr_arg[len(RPATH_PREFIX):], ARG_RPATH))
+    return i + 1
+
+
+def _parse_response_file(args: t.List[str], i: int, emit: _Emit) -> int:
+    curr_arg = args[i]
+    if curr_arg.endswith('.rsp'):
+        # NOTE: we must also hash the rsp file path, but _without_ the @ prefix char
+        emit(ParsedArg(curr_arg[1:], ARG_RSP))
+    else:
+        # likely some rpath argument, not response file, pass as-is
+        emit(ParsedArg(curr_arg))
+    return i + 1
+
+
+# Dispatch on the second character of options, e.g. 'I' for '-Ifoo/bar'
+_OPTION_HANDLERS: t.Dict[str, t.Callable[[t.List[str], int, _Emit], int]] = {
+    'c': _parse_file_option,
+    'o': _parse_file_option,
+    'I': _parse_dir_option,
+    'L': _parse_dir_option,
+    'W': _parse_linker_option,
+}
+
+
+def _parse_option(args: t.List[str], i: int, emit: _Emit) -> int:
+    return _OPTION_HANDLERS.get(args[i][1], _parse_positional)(args, i, emit)
+
+
+# Dispatch on the first character of arguments; anything else is positional
+_HANDLERS: t.Dict[str, t.Callable[[t.List[str], int, _Emit], int]] = {
+    '-': _parse_option,
+    '@': _parse_response_file,
+}
+
+
+def _parse(args: t.List[str]) -> t.List[ParsedArg]:
+    # name of the game: attempt to recognize when file paths are passed as argument,
+    # so that those paths can be hash-aliased with symlinks, then pass the alias in place
+    # of the original argument.
+    # Default fallback is to pass all unrecognized arguments as-is.
+    #
+    # This is merely a heuristic, and may fail in some unforeseen cases. However,
+    # it should be easy to augment those cases when needed. Due to operaiting principle
+    # (symlinks to original dirs), the compilation should succeed just fine even if
+    # all file paths are not captured
+    #
+    # NOTE: this function must not touch the filesystem, see hijack() for that.
+
+    parsed: t.List[ParsedArg] = []
+    emit = parsed.append
+
+    n = len(args)
+    i = 0
+    while i < n:
+        curr_arg = args[i]
 
+        if len(curr_arg) < 2:
+            emit(ParsedArg(curr_arg))
+            i += 1
+            continue
 
-def hash_dir(path: Path) -> Path:
-    return Path(hashlib.blake2b(bytes(path), digest_size=HEX_DIGEST_SIZE_BYTES).hexdigest())
+        i = _HANDLERS.get(curr_arg[0], _parse_positional)(args, i, emit)
 
+    return parsed
 
-def hijack(args: t.List[str], config: Config) -> t.List[str]:
-    (config.cwd / config.prefix).mkdir(parents=True, exist_ok=True)
 
-    def simple_hash_file(file_path: Path) -> Path:
-        file_path = Path(file_path)
-        return simple_hash_dir(file_path.parent) / file_path.name
+# for naming temporary links uniquely, across processes and within this one
+_tmp_link_counter = itertools.count()
+
 
-    def simple_hash_dir(file_path: Path) -> Path:
-        file_path = Path(file_path)
-        return config.prefix / hash_dir(file_path)
+def _make_alias(alias_path: str, target: str) -> None:
+    # Concurrent processes may well attempt to create the same alias; in the common
+    # case it already exists with the correct target, so the symlink call fails and
+    # that's that.
+    try:
+        os.symlink(target, alias_path)
+        return
+    except FileExistsError:
+        try:
+            if os.readlink(alias_path) == target:
+                return
+        except OSError:
+            pass
 
-    def hash_rsp_contents(infile: Path) -> Path:
-        infile = Path(infile)
-        outfile = infile.parent / f'_jacked_{infile.name}'
+    # Existing alias is stale (e.g. the build directory was moved). Replace it
+    # via the atomicity of rename, so that concurrent processes never observe
+    # a missing alias
+    tmp_link = f'{alias_path}.{os.getpid()}.{next(_tmp_link_counter)}'
+    os.symlink(target, tmp_link)
+    os.rename(tmp_link, alias_path)
+
+
+def _rewrite(args: t.List[str], config: Config) -> t.Tuple[t.List[str], t.Dict[str, str]]:
+    # Returns the rewritten arguments, and the aliases they refer to mapped to the
+    # directories the aliases should point to. The aliases are not created here.
+
+    # loop invariants
+    cwd = config.cwd
+    prefix = config.prefix
+
+    alias_dirs: t.Dict[str, str] = {}
+
+    def simple_hash_dir(dir_path: str) -> str:
+        if (alias_dir := alias_dirs.get(dir_path)) is None:
+            alias_dir = alias_dirs[dir_path] = f'{prefix}/{hash_dir(dir_path)}'
+        return alias_dir
+
+    def hash_rsp_contents(infile: str) -> str:
+        parent, name = os.path.split(infile)
+        outfile = os.path.join(parent, f'_jacked_{name}')
+
+        with open(infile) as f:
+            lines = f.read().splitlines()
+
+        aliased = []
+        for line in lines:
+            parent, name = _split(line.strip())
+            aliased.append(_join(simple_hash_dir(parent), name))
+
+        with open(outfile, 'w') as f:
+            f.write('\n'.join(aliased))
 
-        lines = (Path(line.strip()) for line in infile.read_text().splitlines())
-        aliased = [str(simple_hash_file(file_path)) for file_path in lines]
-        outfile.write_text('\n'.join(aliased))
         assert all(len(path) <= MAX_ARGUMENT_LENGTH for path in aliased), \
                ('modified response file contains too long filenames even '
-                f'after hashing/aliasing, see {str(outfile)}')
+                f'after hashing/aliasing, see {outfile}')
 
         # reroute original rsp argument to the new one
         # NOTE: this path itself has not yet been hashed
         return outfile
 
-    n = len(args)
-    i = 0
-    while i < n:
-        # name of the game: attempt to recognize when file paths are passed as argument,
-        # and hash-alias those paths with symlinks, then pass the alias in place of the
-        # original argument.
-        # Default fallback is to pass all unrecognized arguments as-is.
-        #
-        # This is merely a heuristic, and may fail in some unforeseen cases. However,
-        # it should be easy to augment those cases when needed. Due to operaiting principle
-        # (symlinks to original dirs), the compilation should succeed just fine even if
-        # all file paths are not captured
-
-        curr_arg = args[i]
-        next_arg = None if i+1 >= n else args[i+1]
+    rewritten: t.List[str] = []
 
-        is_rsp = False
-        is_file = True
+    # Maps each alias to the directory it points to. Many arguments typically share
+    # the same parent directory, so this way each alias is created only once.
+    unique_dirs: t.Dict[str, str] = {}
 
-        rpath = '-Wl,-rpath,'
+    for value, kind in _parse(args):
+        if kind == ARG_VERBATIM:
+            arg = value
+        elif kind == ARG_RPATH:
+            # NOTE: join, so that an absolute prefix is kept as-is
+            arg = RPATH_PREFIX + os.path.join(cwd, simple_hash_dir(value))
+        else:
+            # from here onwards, we assume current argument is a file or directory path that
+            # needs to be shortened
+            if kind == ARG_DIR:
+                original_dir = value
+                alias_dir = simple_hash_dir(original_dir)
+                arg = alias_dir
+            else:
+                if kind == ARG_RSP and config.rewrite_rsp:
+                    value = hash_rsp_contents(value)
+                original_dir, name = _split(value)
+                alias_dir = simple_hash_dir(original_dir)
+                arg = ['', '@'][kind == ARG_RSP] + _join(alias_dir, name)
 
-        if len(curr_arg) < 2:
-            yield curr_arg
-            i += 1
-            continue
+            unique_dirs[alias_dir] = original_dir
 
-        if curr_arg in ['-c', '-o']:
-            yield curr_arg
-            is_file = True
-            if not next_arg:
-                break  # out of args
-            curr_arg = next_arg
-            i += 2
-        elif (opt := curr_arg[:2]) in ['-I', '-L']:
-            # handles ['-I', 'foo/bar'] and ['-Ifoo/bar'] equally
-            yield opt
-            is_file = False
-            if remainder := curr_arg[2:]:
-                curr_arg = remainder
-                i += 1
-            elif next_arg:
-                curr_arg = next_arg
-                i += 2
-            else:
-                # out of args
-                break
-        elif curr_arg.startswith(rpath):
-            reldir = Path(curr_arg[len(rpath):])
-            yield rpath + str(config.cwd / simple_hash_dir(reldir))
-            i += 1
-            continue
-        elif curr_arg[0] == '@':
-            if not curr_arg.endswith('.rsp'):
-                # likely some rpath argument, not response file, pass as-is
-                yield curr_arg
-                i += 1
-                continue
+        # Last safety check - prevent accidentally passing invalid args
+        # The inner command might not even handle oversized args gracefully.
+        # We want to avoid silent crashes at all costs
+        if len(arg) > MAX_ARGUMENT_LENGTH:
+            # The whole point of this script is to re-route long paths to shorter aliases,
+            # so if this check trips up with your build, upgrade the heuristic in '_parse()'
+            # so it will be handled appropriately.
+            raise RuntimeError(f'ERROR: argument "{arg}" is {len(arg)} characters long, max: {MAX_ARGUMENT_LENGTH}')
 
-            is_rsp = True
+        rewritten.append(arg)
 
-            # NOTE: we must also hash the rsp file path, but _without_ the @ prefix char
-            path = Path(curr_arg[1:])
+    return rewritten, unique_dirs
 
-            if config.rewrite_rsp:
-                curr_arg = hash_rsp_contents(path)
-            else:
-                curr_arg = path
 
-            is_file = True
-            i += 1
-        elif Path(curr_arg).suffix in ['.a', '.so', '.dylib', '.lib']:
-            # positional argument, usually libraries passed during linking step
-            # Paths to these usually do not have the 'CMakeFiles' component in them
-            is_file = True
-            i += 1
-        elif 'CMakeFiles' in curr_arg:
-            if Path(curr_arg).suffix not in ['.d', '.o', '.dep']:
-                # There might be omissions, add known extensions to the above list if needed
-                raise RuntimeError(f'Uknown CMakeFiles file type: {curr_arg}?')
-            i += 1
-        else:
-            # Anything our heuristic did not recognize is passed as-is
-            yield curr_arg
-            i += 1
-            continue
+def _make_aliases(aliases: t.Dict[str, str], config: Config) -> t.Dict[str, str]:
+    # Returns the aliases mapped to the targets they were pointed to
+    cwd = config.cwd
+    targets: t.Dict[str, str] = {}
 
-        # from here onwards, we assume current argument is a file or directory path that
-        # needs to be shortened
+    os.makedirs(config.prefix_dir, exist_ok=True)
 
-        curr_arg = Path(curr_arg)
+    # NOTE: all aliases live in the same prefix directory, so creating them from
+    # multiple threads only contends on that directory; do it serially.
+    for alias_dir, original_dir in aliases.items():
+        # Normalized via Path, so that e.g. 'foo' and './foo/' yield the same target;
+        # otherwise concurrent processes would keep replacing each other's aliases.
+        # This is done once per alias, not per argument.
+        target = targets[alias_dir] = os.fspath(Path(cwd, original_dir))
 
-        if is_file:
-            original_dir = curr_arg.parent
-            alias_dir = simple_hash_dir(original_dir)
-            rewritten = ['', '@'][is_rsp] + str(alias_dir / curr_arg.name)
-        else:
-            original_dir = curr_arg
-            alias_dir = simple_hash_dir(original_dir)
-            rewritten = str(alias_dir)
+        # NOTE: join, since alias_dir is absolute if the prefix is
+        _make_alias(os.path.join(cwd, alias_dir), target)
 
-        if original_dir.is_absolute():
-            target = original_dir
-        else:
-            target = config.cwd / original_dir
+    return targets
 
-        # It is possible that multiple processes want attempt to create this same alias
-        # symlink concurrently; use atomicity of rename to prevent race conditions
-        # from ruining our day
-        tmp_link = alias_dir.with_name(str(hash(alias_dir)) + str(hash(curr_arg)))
-        os.symlink(target, config.cwd / tmp_link)
-        os.rename(config.cwd / tmp_link, config.cwd / alias_dir)
 
-        yield rewritten
+def hijack(args: t.List[str], config: Config) -> t.List[str]:
+    rewritten, aliases = _rewrite(args, config)
+    _make_aliases(aliases, config)
+    return rewritten
+
+
+def hijack_cached(args: t.List[str], config: Config) -> t.List[str]:
+    # Same as hijack(), but the result is remembered on disk. Build tools invoke the very
+    # same commands over and over again, so on a cache hit we only need to check that the
+    # aliases still point to the right place. They might not, e.g. if an absolute prefix is
+    # shared between build directories.
+    # NOTE: contents of response files are not part of the cache key, so this must not
+    # be used together with config.rewrite_rsp.
+    key = hashlib.blake2b(
+        repr((CACHE_VERSION, HASH_ALGORITHM, MAX_ARGUMENT_LENGTH, config.cwd, config.prefix, args)).encode(),
+        digest_size=16,
+    ).hexdigest()
+    cache_dir = os.path.join(config.prefix_dir, '.cache')
+    cache_file = os.path.join(cache_dir, f'{key}.json')
+
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        cwd = config.cwd
+        if all(os.readlink(os.path.join(cwd, alias_dir)) == target
+               for alias_dir, target in cached['aliases'].items()):
+            return cached['args']
+    except (OSError, ValueError, KeyError):
+        pass  # treat unreadable entries as misses
+
+    rewritten, aliases = _rewrite(args, config)
+    targets = _make_aliases(aliases, config)
+
+    # concurrent processes may write the same entry, so write it atomically
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump({'args': rewritten, 'aliases': targets}, f)
+    os.replace(tmp_file, cache_file)
+
+    return rewritten
+
+
+# Characters which shlex.quote() never needs to escape, plus the space separator
+_UNSAFE_CHARS_RE = re.compile(r'[^\w@%+=:,./ -]', re.ASCII)
+
+
+def _format_argv(argv: t.List[str]) -> str:
+    # Rewritten arguments rarely need any quoting; check that once for the whole
+    # command line instead of having shlex.join() check each argument separately.
+    line = ' '.join(argv)
+    if _UNSAFE_CHARS_RE.search(line) is None and line.count(' ') == len(argv) - 1 and '' not in argv:
+        return line
+    return shlex.join(argv)
 
 
 def main(argv):
@@ -194,25 +446,19 @@ def main(argv):
 
     config.rewrite_rsp = cmd_name in cmds_needing_rsp_rewrite or rewrite_force
 
-    modified_args = list(hijack(args, config))
-
-    for i, arg in enumerate(modified_args):
-        # Last safety check - prevent accidentally passing invalid args
-        # The inner command might not even handle oversized args gracefully.
-        # We want to avoid silent crashes at all costs
-        if len(arg) <= MAX_ARGUMENT_LENGTH:
-            continue
-        # The whole point of this script is to re-route long paths to shorter aliases,
-        # so if this check trips up with your build, upgrade the heuristic in 'hijack()'
-        # so it will be handled appropriately.
-        raise RuntimeError(f'ERROR: argument "{arg}" is {len(arg)} characters long, max: {MAX_ARGUMENT_LENGTH}')
+    # Opt-in, since it leaves a cache file for every distinct command in the prefix directory
+    if os.getenv('JACKMAN_CACHE', False) and not config.rewrite_rsp:
+        modified_args = hijack_cached(args, config)
+    else:
+        modified_args = hijack(args, config)
 
+    # NOTE: the length of each argument has already been checked by hijack()
     new_argv = [cmd] + modified_args
 
     b = time.perf_counter()
 
     if os.getenv('JACKMAN_VERBOSE', False):
-        print('>>> [jackman] REWRITE:', shlex.join(new_argv), file=sys.stderr)
+        print('>>> [jackman] REWRITE:', _format_argv(new_argv), file=sys.stderr)
 
     if os.getenv('JACKMAN_DEBUG_PERF', False):
         print(f'>>> [jackman] PERF: {(b-a)*1000:.2f} ms', file=sys.stderr)
@@ -1,6 +1,22 @@
+import shlex
+import pytest
 import jackman
 from pathlib import Path
 
+# Expected aliases depend on which hash function jackman picked up
+HASHES = {
+    'blake2b': {
+        'foo/bar': 'ad884951a73c822f',
+        'path/to/include': 'b9e95d2b2621ea80',
+        '.': 'f01d79cfb6e37084',
+    },
+    'blake3': {
+        'foo/bar': '2d461fe86150561a',
+        'path/to/include': '11d520d40d407e1a',
+        '.': 'a2b910880c859d38',
+    },
+}[jackman.HASH_ALGORITHM]
+
 
 def test_simple(tmp_path):
     config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve())
@@ -12,9 +28,9 @@ def test_simple(tmp_path):
     ]
     expect = [
         'gcc', '-Wall', '-Wextra',
-        '-c', '_pytest/ad884951a73c822f/baz.c',  # hash(b'foo/bar') = ad88...822f
-        '-I', '_pytest/b9e95d2b2621ea80',        # hash(b'path/to') = b9e9...ea80
-        '-o', '_pytest/f01d79cfb6e37084/myexe'   # hash(b'.')       = f01d...7084
+        '-c', f'_pytest/{HASHES["foo/bar"]}/baz.c',
+        '-I', f'_pytest/{HASHES["path/to/include"]}',
+        '-o', f'_pytest/{HASHES["."]}/myexe'
     ]
     res = list(jackman.hijack(args, config))
 
@@ -23,10 +39,191 @@ def test_simple(tmp_path):
 
     fs = list(tmp_path.rglob('_pytest/*'))
     assert len(fs) == 3
-    assert (tmp_path / '_pytest/ad884951a73c822f').is_symlink()
-    assert (tmp_path / '_pytest/b9e95d2b2621ea80').is_symlink()
-    assert (tmp_path / '_pytest/f01d79cfb6e37084').is_symlink()
+    assert (tmp_path / f'_pytest/{HASHES["foo/bar"]}').is_symlink()
+    assert (tmp_path / f'_pytest/{HASHES["path/to/include"]}').is_symlink()
+    assert (tmp_path / f'_pytest/{HASHES["."]}').is_symlink()
+
+    assert (tmp_path / f'_pytest/{HASHES["foo/bar"]}').readlink().relative_to(tmp_path) == Path('foo/bar')
+    assert (tmp_path / f'_pytest/{HASHES["path/to/include"]}').readlink().relative_to(tmp_path) == Path('path/to/include')
+    assert (tmp_path / f'_pytest/{HASHES["."]}').readlink().relative_to(tmp_path) == Path('.')
+
+
+def test_existing_aliases_are_reused(tmp_path):
+    config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve())
+    args = ['-c', 'foo/bar/baz.c', '-o', 'foo/bar/baz.o', '-Ifoo/bar']
+
+    first = list(jackman.hijack(args, config))
+    second = list(jackman.hijack(args, config))
+
+    assert first == second
+    assert [p.name for p in tmp_path.rglob('_pytest/*')] == [HASHES['foo/bar']]
+    assert (tmp_path / f'_pytest/{HASHES["foo/bar"]}').readlink().relative_to(tmp_path) == Path('foo/bar')
+
+
+def test_stale_alias_is_replaced(tmp_path):
+    config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve())
+    alias = tmp_path / f'_pytest/{HASHES["foo/bar"]}'
+    alias.parent.mkdir()
+    alias.symlink_to('/some/old/build/dir/foo/bar')
+
+    res = list(jackman.hijack(['-c', 'foo/bar/baz.c'], config))
+
+    assert res == ['-c', f'_pytest/{HASHES["foo/bar"]}/baz.c']
+    assert [p.name for p in tmp_path.rglob('_pytest/*')] == [HASHES['foo/bar']]
+    assert alias.readlink().relative_to(tmp_path) == Path('foo/bar')
+
+
+def test_rsp_rewrite(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve(), rewrite_rsp=True)
+    (tmp_path / 'objects.rsp').write_text('foo/bar/a.o\nfoo/bar/b.o\nc.o\n')
+
+    res = list(jackman.hijack(['@objects.rsp'], config))
+
+    assert res == [f'@_pytest/{HASHES["."]}/_jacked_objects.rsp']
+    assert (tmp_path / '_jacked_objects.rsp').read_text().splitlines() == [
+        f'_pytest/{HASHES["foo/bar"]}/a.o',
+        f'_pytest/{HASHES["foo/bar"]}/b.o',
+        f'_pytest/{HASHES["."]}/c.o',
+    ]
+
+
+def test_parse():
+    args = [
+        '-c', 'foo/bar/baz.c', '-Wall', '-Ipath/to/include', '-L', 'lib/dir',
+        '-Wl,-rpath,some/lib', '@CMakeFiles/link.rsp', '@foo', 'libz.a',
+        'CMakeFiles/foo.dir/baz.o', '-',
+    ]
+    assert jackman._parse(args) == [
+        ('-c', jackman.ARG_VERBATIM),
+        ('foo/bar/baz.c', jackman.ARG_FILE),
+        ('-Wall', jackman.ARG_VERBATIM),
+        ('-I', jackman.ARG_VERBATIM),
+        ('path/to/include', jackman.ARG_DIR),
+        ('-L', jackman.ARG_VERBATIM),
+        ('lib/dir', jackman.ARG_DIR),
+        ('some/lib', jackman.ARG_RPATH),
+        ('CMakeFiles/link.rsp', jackman.ARG_RSP),
+        ('@foo', jackman.ARG_VERBATIM),
+        ('libz.a', jackman.ARG_FILE),
+        ('CMakeFiles/foo.dir/baz.o', jackman.ARG_FILE),
+        ('-', jackman.ARG_VERBATIM),
+    ]
+
+
+def test_hijack_cached(tmp_path, monkeypatch):
+    config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve())
+    args = ['-c', 'foo/bar/baz.c', '-o', 'foo/bar/baz.o']
+    expect = ['-c', f'_pytest/{HASHES["foo/bar"]}/baz.c', '-o', f'_pytest/{HASHES["foo/bar"]}/baz.o']
+    alias = tmp_path / f'_pytest/{HASHES["foo/bar"]}'
+
+    assert jackman.hijack_cached(args, config) == expect
+    assert len(list(tmp_path.glob('_pytest/.cache/*.json'))) == 1
+    assert alias.is_symlink()
+
+    # cache hit, arguments are not rewritten again
+    rewrite = jackman._rewrite
+
+    def no_rewrite(*args):
+        raise AssertionError('expected a cache hit')
+
+    monkeypatch.setattr(jackman, '_rewrite', no_rewrite)
+    assert jackman.hijack_cached(args, config) == expect
+
+    # cache entry is not trusted if the alias has disappeared
+    monkeypatch.setattr(jackman, '_rewrite', rewrite)
+    alias.unlink()
+    assert jackman.hijack_cached(args, config) == expect
+    assert alias.readlink().relative_to(tmp_path) == Path('foo/bar')
+
+
+def test_too_long_argument(tmp_path):
+    config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve())
+    with pytest.raises(RuntimeError, match='characters long'):
+        jackman.hijack(['-D' + 'x' * jackman.MAX_ARGUMENT_LENGTH], config)
+
+
+@pytest.mark.parametrize('argv', [
+    ['gcc', '-c', '_jackman/ad884951a73c822f/baz.c', '-Wl,-rpath,/foo/bar', '@x.rsp'],
+    ['gcc', '-DFOO="bar baz"'],
+    ['gcc', 'foo bar'],
+    ['gcc', ''],
+    ['gcc', '$HOME'],
+    ['gcc', 'fööbar'],
+])
+def test_format_argv(argv):
+    assert jackman._format_argv(argv) == shlex.join(argv)
+
+
+@pytest.mark.parametrize('absolute', [False, True])
+def test_rpath(tmp_path, absolute):
+    prefix = tmp_path / 'aliases' if absolute else Path('_pytest')
+    config = jackman.Config(prefix=prefix, cwd=tmp_path.resolve())
+
+    res = jackman.hijack(['-Wl,-rpath,foo/bar'], config)
+
+    assert res == [f'-Wl,-rpath,{tmp_path.resolve() / prefix / HASHES["foo/bar"]}']
+
+
+@pytest.mark.parametrize('path', [
+    'foo/bar/baz.c', 'foo/bar/', 'foo//bar', 'baz.c', 'baz.c/', './baz.c', '/baz.c', '/foo/bar/', '/', 'foo/bar.a/',
+    'lib.a/.', 'foo/.', 'foo/./', '.', './', '', '/.', '//', '//.', '///',
+])
+def test_split_and_suffix(path):
+    parent, name = jackman._split(path)
+    assert (Path(parent), name) == (Path(path).parent, Path(path).name)
+    assert jackman._suffix(path) == Path(path).suffix
+
+
+def test_trailing_slash(tmp_path):
+    config = jackman.Config(prefix='_pytest', cwd=tmp_path.resolve())
+
+    res = jackman.hijack(['-c', 'foo/bar/', 'foo/bar.a/'], config)
+
+    assert res == ['-c', f'_pytest/{jackman.hash_dir("foo")}/bar', f'_pytest/{jackman.hash_dir("foo")}/bar.a']
+
+
+def test_hijack_cached_repointed_alias(tmp_path):
+    # two build directories sharing an absolute prefix use the very same aliases
+    prefix = tmp_path / 'aliases'
+    build_a, build_b = tmp_path / 'a', tmp_path / 'b'
+    config_a = jackman.Config(prefix=prefix, cwd=build_a)
+    config_b = jackman.Config(prefix=prefix, cwd=build_b)
+    args = ['-c', 'foo/bar/baz.c']
+    alias = prefix / HASHES['foo/bar']
+
+    assert jackman.hijack_cached(args, config_a) == jackman.hijack_cached(args, config_b)
+    assert alias.readlink() == build_b / 'foo/bar'
+
+    # cache entry of build A is not trusted, since the alias now points into build B
+    jackman.hijack_cached(args, config_a)
+    assert alias.readlink() == build_a / 'foo/bar'
+
+
+def test_hijack_cached_absolute_prefix(tmp_path, monkeypatch):
+    prefix = tmp_path / 'aliases'
+    config = jackman.Config(prefix=prefix, cwd=tmp_path.resolve())
+    args = ['-c', 'foo/bar/baz.c']
+    expect = ['-c', f'{prefix}/{HASHES["foo/bar"]}/baz.c']
+
+    assert jackman.hijack_cached(args, config) == expect
+    assert jackman.hijack_cached(args, config) == expect
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['aliases']
+    assert len(list(prefix.glob('.cache/*.json'))) == 1
+
+    # entries cached by other versions of jackman are not reused
+    monkeypatch.setattr(jackman, 'CACHE_VERSION', jackman.CACHE_VERSION + 1)
+    assert jackman.hijack_cached(args, config) == expect
+    assert len(list(prefix.glob('.cache/*.json'))) == 2
+
+
+def test_absolute_prefix(tmp_path):
+    prefix = tmp_path / 'aliases'
+    config = jackman.Config(prefix=prefix, cwd=tmp_path.resolve())
+
+    res = jackman.hijack(['-c', 'foo/bar/baz.c', '-Ipath/to/include'], config)
 
-    assert (tmp_path / '_pytest/ad884951a73c822f').readlink().relative_to(tmp_path) == Path('foo/bar')
-    assert (tmp_path / '_pytest/b9e95d2b2621ea80').readlink().relative_to(tmp_path) == Path('path/to/include')
-    assert (tmp_path / '_pytest/f01d79cfb6e37084').readlink().relative_to(tmp_path) == Path('.')
+    assert res == ['-c', f'{prefix}/{HASHES["foo/bar"]}/baz.c', '-I', f'{prefix}/{HASHES["path/to/include"]}']
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['aliases']
+    assert (prefix / HASHES['foo/bar']).readlink().relative_to(tmp_path) == Path('foo/bar')
+    assert (prefix / HASHES['path/to/include']).readlink().relative_to(tmp_path) == Path('path/to/include')